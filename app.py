@@ -3,6 +3,18 @@ import numpy as np
 import streamlit as st
 from PIL import Image
 import io
+import logging
+import os
+
+# Streamlit only configures its own loggers and runs this file as __main__,
+# so give the app a named logger with its own handler. The logging registry
+# outlives reruns; the handler check keeps it from being added twice
+logger = logging.getLogger("document_scanner")
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
 
 # ============================================================================
 # CONFIGURATION
@@ -13,7 +25,43 @@ class Config:
     CANNY_THRESHOLD1 = 75
     CANNY_THRESHOLD2 = 200
     GAUSSIAN_BLUR = (5, 5)
+    GAUSSIAN_SIGMA = 1.0
     CONTOUR_APPROX_FACTOR = 0.02
+    DETECTION_HEIGHT = 500
+    CANDIDATE_CONTOURS = 5
+    EXPORT_FORMATS = ["JPG", "PNG", "WEBP", "PDF"]
+    DISPLAY_WIDTH = 800
+    MAX_NOISE_REDUCTION = 5
+    PDF_MAX_SIDE = 2200
+    PDF_RESOLUTION = 200.0
+
+# ============================================================================
+# OPENCV RUNTIME
+# ============================================================================
+
+# Run OpenCV's parallel loops on every core and keep its SIMD kernels enabled
+cv2.setUseOptimized(True)
+cv2.setNumThreads(os.cpu_count() or 4)
+
+# Route T-API (cv2.UMat) calls to OpenCL devices such as an integrated GPU
+cv2.ocl.setUseOpenCL(cv2.ocl.haveOpenCL())
+USE_OPENCL = cv2.ocl.useOpenCL()
+
+@st.cache_resource(show_spinner=False)
+def log_opencv_features():
+    """
+    Log OpenCV threading and CPU feature dispatch once per server process
+    Pip wheels dispatch AVX2 kernels at runtime; custom builds should use
+    -D CPU_BASELINE=AVX2 -D CPU_DISPATCH=AVX512_SKX
+    Returns: True if the build ships AVX2 kernels
+    """
+    cpu_features = [" ".join(line.split()) for line in cv2.getBuildInformation().splitlines()
+                    if line.strip().startswith(("Baseline:", "Dispatched code generation:"))]
+    has_avx2 = any("AVX2" in line.split() for line in cpu_features)
+    logger.info("OpenCV %s | threads: %d | optimized: %s | OpenCL: %s | AVX2: %s | %s",
+                cv2.__version__, cv2.getNumThreads(), cv2.useOptimized(),
+                USE_OPENCL, has_avx2, " | ".join(cpu_features))
+    return has_avx2
 
 # ============================================================================
 # CORE IMAGE PROCESSING FUNCTIONS
@@ -24,14 +72,15 @@ def order_points(pts):
     Order corner points in clockwise order starting from top-left
     Returns: [top-left, top-right, bottom-right, bottom-left]
     """
-    rect = np.zeros((4, 2), dtype="float32")
-    s = pts.sum(axis=1)
-    rect[0] = pts[np.argmin(s)]   # top-left (smallest sum)
-    rect[2] = pts[np.argmax(s)]   # bottom-right (largest sum)
-    diff = np.diff(pts, axis=1)
-    rect[1] = pts[np.argmin(diff)]  # top-right
-    rect[3] = pts[np.argmax(diff)]  # bottom-left
-    return rect
+    pts = np.asarray(pts, dtype=np.float32).reshape(4, 2)
+    s = pts[:, 0] + pts[:, 1]
+    d = pts[:, 1] - pts[:, 0]
+    return pts[[
+        np.argmin(s),   # top-left (smallest sum)
+        np.argmin(d),   # top-right (smallest y - x)
+        np.argmax(s),   # bottom-right (largest sum)
+        np.argmax(d),   # bottom-left (largest y - x)
+    ]]
 
 def four_point_transform(image, pts):
     """
@@ -58,89 +107,159 @@ def four_point_transform(image, pts):
     
     # Compute and apply perspective transform
     M = cv2.getPerspectiveTransform(rect, dst)
-    warped = cv2.warpPerspective(image, M, (maxWidth, maxHeight))
+    warped = cv2.warpPerspective(image, M, (maxWidth, maxHeight), flags=cv2.INTER_LINEAR)
     return warped
 
 def detect_document_contour(image):
     """
     Detect document boundary using edge detection and contour approximation
+    Accepts an RGB or precomputed grayscale image. Detection runs on a copy
+    downscaled to DETECTION_HEIGHT; the contour is scaled back to
+    full-resolution coordinates
     Returns: (contour, edges_image)
     """
-    # Convert to grayscale and apply Gaussian blur
-    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-    gray = cv2.GaussianBlur(gray, Config.GAUSSIAN_BLUR, 0)
+    # Downscale large images, edge detection cost grows with pixel count
+    ratio = max(image.shape[0] / float(Config.DETECTION_HEIGHT), 1.0)
+    if ratio > 1.0:
+        small = cv2.resize(image, (int(image.shape[1] / ratio), Config.DETECTION_HEIGHT))
+    else:
+        small = image
+    
+    # Convert to grayscale (if needed) and apply separable Gaussian blur
+    gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY) if small.ndim == 3 else small
+    gray = cv2.GaussianBlur(gray, Config.GAUSSIAN_BLUR, Config.GAUSSIAN_SIGMA, sigmaY=0)
     
     # Edge detection
     edges = cv2.Canny(gray, Config.CANNY_THRESHOLD1, Config.CANNY_THRESHOLD2)
     
-    # Find contours and sort by area
-    contours, _ = cv2.findContours(edges.copy(), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-    contours = sorted(contours, key=cv2.contourArea, reverse=True)[:5]
+    # Find contours and keep the largest candidates by area
+    contours, _ = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    areas = np.fromiter((cv2.contourArea(c) for c in contours), dtype=np.float64,
+                        count=len(contours))
+    # Stable sort keeps contour order on equal areas, like sorted(reverse=True)
+    top = np.argsort(-areas, kind="stable")[:Config.CANDIDATE_CONTOURS]
     
-    # Find the first 4-sided contour (assumed to be document)
+    # Find the first 4-sided contour (assumed to be document); the largest
+    # candidate usually matches, so later approximations are skipped
     doc_contour = None
-    for contour in contours:
+    for i in top:
+        contour = contours[i]
         peri = cv2.arcLength(contour, True)
         approx = cv2.approxPolyDP(contour, Config.CONTOUR_APPROX_FACTOR * peri, True)
         if len(approx) == 4:
-            doc_contour = approx
+            # Map corners back to full-resolution coordinates
+            doc_contour = approx.astype(np.float32) * ratio
             break
     
     return doc_contour, edges
 
+@st.cache_resource(show_spinner=False)
+def noise_kernels():
+    """
+    Build rectangular structuring elements for every noise reduction level
+    Cached per server process, since the script body re-runs on every rerun
+    Returns: list indexed by level (index 0 means no noise reduction)
+    """
+    return [None] + [
+        cv2.getStructuringElement(cv2.MORPH_RECT, (k, k))
+        for k in range(1, Config.MAX_NOISE_REDUCTION + 1)]
+
 def apply_noise_reduction(image, kernel_size):
     """
     Apply morphological operations to reduce noise
+    A rectangular structuring element lets OpenCV use its separable
+    row/column erode and dilate instead of a full 2D kernel scan
+    Runs through OpenCL (cv2.UMat) when available
     """
     if kernel_size > 0:
-        kernel = np.ones((kernel_size, kernel_size), np.uint8)
+        kernel = noise_kernels()[kernel_size]
+        src = cv2.UMat(image) if USE_OPENCL else image
         # Closing: removes small black holes
-        image = cv2.morphologyEx(image, cv2.MORPH_CLOSE, kernel)
+        image = cv2.morphologyEx(src, cv2.MORPH_CLOSE, kernel)
         # Opening: removes small white noise
         image = cv2.morphologyEx(image, cv2.MORPH_OPEN, kernel)
+        # Download from the device only after both passes have run
+        if isinstance(image, cv2.UMat):
+            image = image.get()
     return image
 
-def apply_scan_mode(warped_image, mode, noise_reduction):
+def adaptive_threshold(image, method, block_size, c):
     """
-    Apply different scanning modes to the warped image
+    Binary adaptive threshold, bit-identical to cv2.adaptiveThreshold with THRESH_BINARY
+    Computes the local mean with a box filter (or float Gaussian) and compares
+    in one saturating subtract + compare, with no signed intermediate image
+    Accepts ndarray or cv2.UMat
     """
-    warped_gray = cv2.cvtColor(warped_image, cv2.COLOR_RGB2GRAY)
+    if method == cv2.ADAPTIVE_THRESH_MEAN_C:
+        mean = cv2.boxFilter(image, -1, (block_size, block_size),
+                             borderType=cv2.BORDER_REPLICATE)
+    else:
+        # OpenCV blurs in float for the Gaussian method; match it exactly
+        image_f = cv2.multiply(image, 1.0, dtype=cv2.CV_32F)
+        mean = cv2.convertScaleAbs(cv2.GaussianBlur(
+            image_f, (block_size, block_size), 0, borderType=cv2.BORDER_REPLICATE))
+    
+    # pixel > mean - c, rewritten so uint8 saturation cannot change the result
+    if c > 0:
+        return cv2.compare(cv2.subtract(mean, image), c, cv2.CMP_LT)
+    return cv2.compare(cv2.subtract(image, mean), -c, cv2.CMP_GT)
+
+def apply_scan_mode(warped_gray, mode):
+    """
+    Apply different scanning modes to the warped grayscale image
+    Expects a single-channel input; grayscale conversion happens before the warp
+    Noise reduction is a separate stage so the slider does not re-threshold
+    Thresholding runs through OpenCL (cv2.UMat) when available
+    """
+    # OpenCV falls back to CPU kernels if no OpenCL device works
+    src = cv2.UMat(warped_gray) if USE_OPENCL else warped_gray
     
     if mode == "Black & White":
         # Adaptive thresholding for clean B&W output
-        scanned = cv2.adaptiveThreshold(
-            warped_gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY, 11, 2)
-        scanned = apply_noise_reduction(scanned, noise_reduction)
-        return scanned
+        scanned = adaptive_threshold(src, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 11, 2)
     
     elif mode == "Enhanced B&W":
         # More aggressive thresholding for documents with backgrounds
-        scanned = cv2.adaptiveThreshold(
-            warped_gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, 
-            cv2.THRESH_BINARY, 15, 10)
-        scanned = apply_noise_reduction(scanned, noise_reduction)
-        return scanned
+        scanned = adaptive_threshold(src, cv2.ADAPTIVE_THRESH_MEAN_C, 15, 10)
+    
+    else:
+        return warped_gray
     
-    return warped_image
+    return scanned.get() if isinstance(scanned, cv2.UMat) else scanned
 
 # ============================================================================
 # UTILITY FUNCTIONS
 # ============================================================================
 
-def draw_corners(image, corners, radius=10):
+def for_display(image, width=Config.DISPLAY_WIDTH):
+    """
+    Downscale image to display width so the browser is not sent full resolution
+    Images already narrower than width are returned unchanged
+    """
+    if image.shape[1] <= width:
+        return image
+    height = int(image.shape[0] * width / float(image.shape[1]))
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+def draw_corners(image, corners, radius=10, display_width=Config.DISPLAY_WIDTH):
     """
     Draw corner points and boundary on image for visualization
+    Draws on a copy downscaled to display_width instead of the full-resolution image
+    Returns: display-sized RGB image
     """
-    output = image.copy()
-    for i, corner in enumerate(corners):
-        x, y = int(corner[0]), int(corner[1])
+    output = for_display(image, display_width)
+    if output is image:
+        output = image.copy()
+    scale = output.shape[1] / float(image.shape[1])
+    corners = (np.asarray(corners, dtype=np.float32) * scale).astype(np.int32)
+    
+    # Draw boundary lines
+    cv2.polylines(output, [corners], True, (0, 255, 0), 3)
+    for i, (x, y) in enumerate(corners.tolist()):
         # Draw circles at corners
         cv2.circle(output, (x, y), radius, (0, 255, 0), -1)
         # Add corner numbers
         cv2.putText(output, str(i+1), (x+15, y), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 0, 0), 2)
-    # Draw boundary lines
-    cv2.polylines(output, [corners.astype(np.int32)], True, (0, 255, 0), 3)
     return output
 
 def create_download_link(image, filename, format_type):
@@ -156,21 +275,107 @@ def create_download_link(image, filename, format_type):
     else:  # Color
         pil_img = Image.fromarray(image)
     
+    # Thresholded scans hold only 0/255 and can be packed to 1 bit per pixel
+    is_binary = (image.dtype == np.uint8 and len(image.shape) == 2
+                 and bool(((image == 0) | (image == 255)).all()))
+    
     # Save in requested format
     if format_type == "PDF":
-        pil_img.save(buffered, format="PDF")
+        # Large pages are shrunk to ~200 DPI on letter size, visually identical
+        # for scanned text; smaller pages keep Pillow's default page size
+        pdf_options = {}
+        if max(pil_img.size) > Config.PDF_MAX_SIDE:
+            pil_img.thumbnail((Config.PDF_MAX_SIDE, Config.PDF_MAX_SIDE), Image.LANCZOS)
+            pdf_options["resolution"] = Config.PDF_RESOLUTION
+        if is_binary:
+            pil_img = pil_img.convert('1', dither=Image.Dither.NONE)
+        pil_img.save(buffered, format="PDF", **pdf_options)
         mime_type = "application/pdf"
     elif format_type == "PNG":
+        if is_binary:
+            pil_img = pil_img.convert('1', dither=Image.Dither.NONE)
         pil_img.save(buffered, format="PNG")
         mime_type = "image/png"
+    elif format_type == "WEBP":
+        # Lossless WebP for viewers that prefer it; encodes slower than 1-bit PNG
+        pil_img.save(buffered, format="WEBP", lossless=True, method=4)
+        mime_type = "image/webp"
     else:  # JPG
         if len(image.shape) == 2:
             pil_img = pil_img.convert('RGB')
-        pil_img.save(buffered, format="JPEG", quality=95)
+        pil_img.save(buffered, format="JPEG", quality=95, optimize=True, progressive=True)
         mime_type = "image/jpeg"
     
     return buffered.getvalue(), mime_type
 
+# ============================================================================
+# CACHED PIPELINE STAGES
+# ============================================================================
+
+def corners_key(corners):
+    """
+    Convert corner array to a hashable tuple for use as a cache key
+    """
+    return tuple(map(tuple, np.asarray(corners, dtype=np.float32).tolist()))
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_image(file_bytes):
+    """
+    Decode uploaded file bytes into an RGB array
+    Uses OpenCV's decoder (libjpeg-turbo for JPEG) directly on the raw bytes;
+    EXIF orientation is applied, so rotated phone photos load upright
+    Raises: ValueError if the bytes are not a decodable image
+    """
+    buf = np.frombuffer(file_bytes, np.uint8)
+    bgr = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise ValueError("Could not read the uploaded file as an image")
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_gray(file_bytes):
+    """
+    Convert the uploaded image to grayscale once per upload
+    """
+    return cv2.cvtColor(load_image(file_bytes), cv2.COLOR_RGB2GRAY)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def cached_detect(file_bytes):
+    """
+    Detect document corners once per upload
+    Returns: corners tuple or None if no document was found
+    """
+    doc_contour, _ = detect_document_contour(load_gray(file_bytes))
+    if doc_contour is None:
+        return None
+    return corners_key(doc_contour.reshape(4, 2))
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def cached_warp(file_bytes, corners):
+    """
+    Perspective-correct the grayscale upload for the given corners tuple
+    Both scan modes output grayscale, so only one channel is warped
+    """
+    return four_point_transform(load_gray(file_bytes), np.array(corners, dtype=np.float32))
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def cached_threshold(file_bytes, corners, mode):
+    """
+    Apply scan mode thresholding to the cached warp
+    Independent of noise reduction, which is applied on top of this result
+    """
+    return apply_scan_mode(cached_warp(file_bytes, corners), mode)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def cached_exports(image):
+    """
+    Encode the scanned image into every export format once per page
+    Returns: {format_type: (file_data, mime_type)}
+    """
+    return {
+        fmt: create_download_link(image, f"scanned_document.{fmt.lower()}", fmt)
+        for fmt in Config.EXPORT_FORMATS}
+
 # ============================================================================
 # STREAMLIT APPLICATION
 # ============================================================================
@@ -180,6 +385,7 @@ def main():
     
     # Page configuration
     st.set_page_config(page_title="📄 Document Scanner", layout="wide")
+    log_opencv_features()
     st.title("📄 Smart Document Scanner")
     st.write("Upload a document image to automatically detect, transform, and export as a clean scanned copy")
     
@@ -190,6 +396,8 @@ def main():
         st.session_state.image = None
     if 'processed_image' not in st.session_state:
         st.session_state.processed_image = None
+    if 'thresh_cache' not in st.session_state:
+        st.session_state.thresh_cache = None
     
     # Sidebar settings
     with st.sidebar:
@@ -208,7 +416,7 @@ def main():
         noise_reduction = st.slider(
             "Noise Reduction",
             min_value=0,
-            max_value=5,
+            max_value=Config.MAX_NOISE_REDUCTION,
             value=2,
             help="Higher values remove more noise but may lose detail")
         
@@ -219,15 +427,20 @@ def main():
     uploaded_file = st.file_uploader("Upload Document Image", type=Config.SUPPORTED_FORMATS)
     
     if uploaded_file is not None:
-        # Load image
-        image = np.array(Image.open(uploaded_file))
+        # Load image (file bytes serve as the cache key for every stage)
+        file_bytes = uploaded_file.getvalue()
+        try:
+            image = load_image(file_bytes)
+        except ValueError:
+            st.error("❌ Could not read this file. Please upload a valid JPG or PNG image.")
+            return
         st.session_state.image = image
         
         # Auto-detect corners on first load
         if st.session_state.corners is None:
-            doc_contour, edges = detect_document_contour(image)
-            if doc_contour is not None:
-                st.session_state.corners = doc_contour.reshape(4, 2)
+            detected = cached_detect(file_bytes)
+            if detected is not None:
+                st.session_state.corners = np.array(detected, dtype=np.float32)
             else:
                 # Fallback: use image corners if detection fails
                 h, w = image.shape[:2]
@@ -255,20 +468,28 @@ def main():
                 display_img = draw_corners(image, st.session_state.corners)
                 st.image(display_img, width="stretch")
             else:
-                st.image(image, width="stretch")
+                st.image(for_display(image), width="stretch")
                 st.error("❌ No document detected. Try a clearer image with visible edges.")
         
         with col2:
             if st.session_state.corners is not None:
-                # Apply perspective transformation
-                warped = four_point_transform(image, st.session_state.corners)
+                # Warp and threshold only when the upload, corners or mode change;
+                # noise reduction slider ticks reuse the thresholded page
+                thresh_key = (uploaded_file.file_id,
+                              corners_key(st.session_state.corners), scan_mode)
+                if (st.session_state.thresh_cache is None
+                        or st.session_state.thresh_cache[0] != thresh_key):
+                    thresh_img = cached_threshold(file_bytes, thresh_key[1], scan_mode)
+                    st.session_state.thresh_cache = (thresh_key, thresh_img)
                 
-                # Apply selected scan mode
-                scanned = apply_scan_mode(warped, scan_mode, noise_reduction)
+                # Apply noise reduction on top of the cached threshold output
+                scanned = apply_noise_reduction(
+                    st.session_state.thresh_cache[1], noise_reduction)
                 st.session_state.processed_image = scanned
                 
                 # Display scanned image
-                st.image(scanned, width="stretch", clamp=True)
+                # Full-resolution result is kept for export only
+                st.image(for_display(scanned), width="stretch", clamp=True)
             else:
                 st.warning("⚠️ Please upload a clearer image with visible edges")
         
@@ -294,11 +515,11 @@ def main():
             # Show format selection when export is clicked
             if export_clicked:
                 st.info("📦 Choose your export format:")
-                format_col1, format_col2, format_col3 = st.columns(3)
+                format_col1, format_col2, format_col3, format_col4 = st.columns(4)
+                exports = cached_exports(st.session_state.processed_image)
                 
                 with format_col1:
-                    file_data_jpg, mime_jpg = create_download_link(
-                        st.session_state.processed_image, "scanned_doc.jpg", "JPG")
+                    file_data_jpg, mime_jpg = exports["JPG"]
                     st.download_button(
                         label="📄 JPG",
                         data=file_data_jpg,
@@ -307,8 +528,7 @@ def main():
                         width="stretch")
                 
                 with format_col2:
-                    file_data_png, mime_png = create_download_link(
-                        st.session_state.processed_image, "scanned_doc.png", "PNG")
+                    file_data_png, mime_png = exports["PNG"]
                     st.download_button(
                         label="🖼️ PNG",
                         data=file_data_png,
@@ -317,8 +537,16 @@ def main():
                         width="stretch")
                 
                 with format_col3:
-                    file_data_pdf, mime_pdf = create_download_link(
-                        st.session_state.processed_image, "scanned_doc.pdf", "PDF")
+                    file_data_webp, mime_webp = exports["WEBP"]
+                    st.download_button(
+                        label="🌐 WEBP",
+                        data=file_data_webp,
+                        file_name="scanned_document.webp",
+                        mime=mime_webp,
+                        width="stretch")
+                
+                with format_col4:
+                    file_data_pdf, mime_pdf = exports["PDF"]
                     st.download_button(
                         label="📑 PDF",
                         data=file_data_pdf,
@@ -335,7 +563,7 @@ def main():
             2. Auto-detection finds document boundaries (green lines)
             3. Choose scan mode: **Black & White** for text, **Enhanced B&W** for backgrounds
             4. Adjust noise reduction if needed (0-5)
-            5. Click **Export** to download in JPG, PNG, or PDF
+            5. Click **Export** to download in JPG, PNG, WEBP, or PDF
             
             **Tips:**
             - Ensure good lighting and visible document edges